@@ -1,38 +1,31 @@
-import uvicorn
+import asyncio
 import firebase_admin
-import requests
+import httpx
 import os
 import google.generativeai as genai
 import base64
+import hashlib
 import json
-from fastapi import FastAPI, HTTPException, Query
+import time
+import uuid
+import orjson
+from decimal import Decimal, InvalidOperation
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware # Import CORS
-from pydantic import BaseModel
-from typing import List
-from firebase_admin import credentials, firestore
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Tuple
+from firebase_admin import credentials, firestore_async
 from dotenv import load_dotenv
 
 # --- Initialization ---
 load_dotenv()
 db = None
-
-# Firebase Initialization (for Deployment)
-try:
-    firebase_creds_b64 = os.getenv("FIREBASE_SERVICE_ACCOUNT_BASE64")
-    if firebase_creds_b64:
-        creds_json_str = base64.b64decode(firebase_creds_b64).decode('utf-8')
-        creds_dict = json.loads(creds_json_str)
-        cred = credentials.Certificate(creds_dict)
-    else:
-        cred = credentials.Certificate("serviceAccountKey.json")
-
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(cred)
-    
-    db = firestore.client()
-    print("✅ Firebase connection successful.")
-except Exception as e:
-    print(f"🔥 Firebase connection failed: {e}")
+GEMINI_MODEL = None
 
 # Service API Keys
 PAYPAL_CLIENT_ID = os.getenv("PAYPAL_CLIENT_ID")
@@ -42,34 +35,91 @@ PAYPAL_SANDBOX_EMAIL = os.getenv("PAYPAL_SANDBOX_EMAIL")
 OPEN_EXCHANGE_RATES_API_KEY = os.getenv("OPEN_EXCHANGE_RATES_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Configure Gemini AI
-if GEMINI_API_KEY:
+# Firebase Initialization (for Deployment)
+def init_firebase():
+    global db
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ Gemini AI client configured.")
+        firebase_creds_b64 = os.getenv("FIREBASE_SERVICE_ACCOUNT_BASE64")
+        if firebase_creds_b64:
+            creds_json_str = base64.b64decode(firebase_creds_b64).decode('utf-8')
+            creds_dict = json.loads(creds_json_str)
+            cred = credentials.Certificate(creds_dict)
+        else:
+            cred = credentials.Certificate("serviceAccountKey.json")
+
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+
+        # Async client so Firestore reads don't block the event loop
+        db = firestore_async.client()
+        print("✅ Firebase connection successful.")
     except Exception as e:
-        print(f"🔥 Gemini AI configuration failed: {e}")
-else:
-    print("⚠️ Gemini AI key not found. Proxy will not function.")
+        print(f"🔥 Firebase connection failed: {e}")
+
+# Configure Gemini AI
+def init_gemini():
+    global GEMINI_MODEL
+    if GEMINI_API_KEY:
+        try:
+            genai.configure(api_key=GEMINI_API_KEY)
+            GEMINI_MODEL = genai.GenerativeModel('gemini-1.5-flash')
+            print("✅ Gemini AI client configured.")
+        except Exception as e:
+            print(f"🔥 Gemini AI configuration failed: {e}")
+    else:
+        print("⚠️ Gemini AI key not found. Proxy will not function.")
 
 # --- FastAPI App ---
-app = FastAPI()
+# Shared outbound HTTP client, created on startup and closed on shutdown
+http_client: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    init_firebase()
+    init_gemini()
+    # HTTP/2 multiplexes calls to each upstream over one long-lived TLS connection
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=3.0, read=10.0, write=5.0, pool=2.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=32, keepalive_expiry=300),
+    )
+    # Warm up the PayPal token so the first checkout doesn't pay for the OAuth round-trip
+    if PAYPAL_CLIENT_ID and PAYPAL_CLIENT_SECRET:
+        try:
+            await get_paypal_access_token()
+            print("✅ PayPal access token fetched.")
+        except Exception as e:
+            print(f"⚠️ PayPal token warmup failed: {e}")
+    yield
+    await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Upstream still unreachable after retries
+@app.exception_handler(httpx.TransportError)
+async def upstream_unavailable_handler(request: Request, exc: httpx.TransportError):
+    return ORJSONResponse(status_code=502, content={"detail": f"Upstream service unavailable: {exc!r}"})
 
 # --- ADD THIS: CORS Middleware ---
-# This allows your frontend to make requests to your backend
+# This allows your frontend to make requests to your backend.
+# FRONTEND_ORIGIN is a comma-separated list; credentials can't be combined with "*".
+FRONTEND_ORIGINS = [origin.strip() for origin in os.getenv("FRONTEND_ORIGIN", "").split(",") if origin.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
+    allow_origins=FRONTEND_ORIGINS or ["*"],
+    allow_credentials=bool(FRONTEND_ORIGINS),
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,  # Let browsers cache preflight responses for 24h
 )
 
 # --- Pydantic Models ---
 class CartItem(BaseModel):
+    id: str
     name: str
-    quantity: int
-    price: str
+    quantity: int = Field(gt=0)
+    # No client price: order totals always use the price stored in Firestore
 
 class OrderCaptureRequest(BaseModel):
     order_id: str
@@ -78,92 +128,278 @@ class GeminiRequest(BaseModel):
     prompt: str
 
 
-# --- PayPal Helper Functions ---
-def get_paypal_access_token():
-    auth = (PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
-    headers = {"Accept": "application/json", "Accept-Language": "en_US"}
-    data = {"grant_type": "client_credentials"}
+# --- Product Cache ---
+# Serialized product pages keyed by (page_size, start_after, start_after_id); the catalog changes slowly.
+# Clear this from any endpoint that writes products.
+_products_cache = TTLCache(maxsize=256, ttl=60)
+PRODUCTS_CACHE_CONTROL = "public, max-age=30, stale-while-revalidate=60"
+
+async def stream_products(key: Tuple[int, Optional[str], Optional[str]], first_doc, docs):
+    """Yield a product page as JSON while Firestore returns documents, caching the full body once complete.
+
+    The status line is already sent, so a failure mid-page closes the JSON with an "error" field
+    instead of truncating the body, and the partial page is not cached.
+    """
+    chunks = [b'{"items":[']
+    yield chunks[0]
+    next_name = next_id = None
+    error = None
+    doc, separator = first_doc, b""
     try:
-        response = requests.post(f"{PAYPAL_API_BASE}/v1/oauth2/token", auth=auth, headers=headers, data=data)
-        response.raise_for_status()
-        return response.json()["access_token"]
-    except requests.exceptions.HTTPError as err:
-        raise HTTPException(status_code=500, detail=f"Failed to get PayPal token: {err.response.text}")
+        while doc is not None:
+            product = {"id": doc.id, **doc.to_dict()}
+            # Firestore timestamps are datetime subclasses orjson rejects; fall back to FastAPI's encoder
+            chunk = separator + orjson.dumps(product, default=jsonable_encoder)
+            next_name, next_id = product.get("name"), doc.id
+            chunks.append(chunk)
+            yield chunk
+            doc, separator = await anext(docs, None), b","
+    except Exception as e:
+        print(f"🔥 Failed to stream products: {e}")
+        error = f"Failed to fetch products: {e}"
+    tail = b'],"next":' + orjson.dumps(next_name) + b',"next_id":' + orjson.dumps(next_id)
+    if error:
+        yield tail + b',"error":' + orjson.dumps(error) + b"}"
+        return
+    tail += b"}"
+    chunks.append(tail)
+    yield tail
+    _products_cache[key] = b"".join(chunks)
+
+async def fetch_products_for_cart(cart_items: List[CartItem]):
+    """Fetch every product in the cart with a single get_all RPC, returning {id: data}."""
+    if not db:
+        raise HTTPException(status_code=500, detail="Database not connected")
+    products_ref = db.collection('products')
+    refs = [products_ref.document(product_id) for product_id in {item.id for item in cart_items}]
+    try:
+        snapshots = [snapshot async for snapshot in db.get_all(refs)]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch products: {e}")
+    return {snapshot.id: snapshot.to_dict() for snapshot in snapshots if snapshot.exists}
 
-def capture_paypal_order(order_id: str):
-    access_token = get_paypal_access_token()
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
+def get_product_price(product_id: str, product: dict):
+    """Parse a product's stored price as a Decimal, failing with a clear error on bad catalog data."""
     try:
-        response = requests.post(f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}/capture", headers=headers)
+        price = Decimal(str(product["price"]))
+    except (KeyError, InvalidOperation):
+        price = None
+    if price is None or not price.is_finite() or price < 0:
+        raise HTTPException(status_code=500, detail=f"Product '{product_id}' has no valid price.")
+    return price
+
+# --- Outbound HTTP ---
+# Retry only connection-level failures; HTTP error statuses (including 4xx) are returned to the caller
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.1, max=2),
+    retry=retry_if_exception_type(httpx.TransportError),
+    reraise=True,
+)
+async def send_request(method: str, url: str, **kwargs):
+    return await http_client.request(method, url, **kwargs)
+
+# --- PayPal Helper Functions ---
+# Cached OAuth token as (token, monotonic expiry); refreshed 60s before PayPal expires it
+_paypal_token: Optional[Tuple[str, float]] = None
+_paypal_token_lock = asyncio.Lock()
+
+async def get_paypal_access_token():
+    global _paypal_token
+    if _paypal_token and time.monotonic() < _paypal_token[1]:
+        return _paypal_token[0]
+    async with _paypal_token_lock:
+        # Another request may have refreshed the token while we waited
+        if _paypal_token and time.monotonic() < _paypal_token[1]:
+            return _paypal_token[0]
+        auth = (PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
+        headers = {"Accept": "application/json", "Accept-Language": "en_US"}
+        data = {"grant_type": "client_credentials"}
+        try:
+            response = await send_request("POST", f"{PAYPAL_API_BASE}/v1/oauth2/token", auth=auth, headers=headers, data=data)
+            response.raise_for_status()
+            token_data = response.json()
+        except httpx.HTTPStatusError as err:
+            raise HTTPException(status_code=500, detail=f"Failed to get PayPal token: {err.response.text}")
+        expires_in = int(token_data.get("expires_in", 0))
+        _paypal_token = (token_data["access_token"], time.monotonic() + expires_in - 60)
+        return _paypal_token[0]
+
+# Constant parts of the create-order payload, built once
+_PURCHASE_UNIT_TEMPLATE = { "payee": { "email_address": PAYPAL_SANDBOX_EMAIL } }
+_ORDER_PAYLOAD_TEMPLATE = { "intent": "CAPTURE", "application_context": { "return_url": "https://example.com/return", "cancel_url": "https://example.com/cancel" } }
+
+async def capture_paypal_order(order_id: str):
+    access_token = await get_paypal_access_token()
+    # PayPal-Request-Id makes a retried capture idempotent
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}", "PayPal-Request-Id": str(uuid.uuid4())}
+    try:
+        response = await send_request("POST", f"{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}/capture", headers=headers)
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.HTTPError as err:
+    except httpx.HTTPStatusError as err:
         raise HTTPException(status_code=500, detail=f"Failed to capture PayPal order: {err.response.text}")
 
+# --- Exchange Rate Helpers ---
+# Full rates table per base currency as (rates, fetched_at); rates change at most every few hours.
+# Entries stay fresh for RATE_CACHE_TTL and are kept up to a day as a stale-if-error fallback.
+RATE_CACHE_TTL = 3600
+_rate_cache = TTLCache(maxsize=256, ttl=24 * 3600)
+
+async def get_exchange_rates(from_currency: str):
+    """Return (rates, stale) for a base currency, serving the last good table if the upstream fails."""
+    from_currency = from_currency.upper()
+    cached = _rate_cache.get(from_currency)
+    if cached and time.monotonic() - cached[1] < RATE_CACHE_TTL:
+        return cached[0], False
+    try:
+        url = f"https://open.er-api.com/v6/latest/{from_currency}?apikey={OPEN_EXCHANGE_RATES_API_KEY}"
+        response = await send_request("GET", url)
+        response.raise_for_status()
+        rates = response.json().get("rates", {})
+    except httpx.TransportError:
+        if cached:
+            return cached[0], True
+        raise
+    except httpx.HTTPStatusError as err:
+        if cached:
+            return cached[0], True
+        raise HTTPException(status_code=500, detail=f"Failed to get exchange rate: {err.response.text}")
+    # Unknown base currencies come back without rates; don't let them occupy the cache
+    if rates:
+        _rate_cache[from_currency] = (rates, time.monotonic())
+    return rates, False
+
+# --- Gemini Helpers ---
+# Generated text keyed by prompt hash; identical template prompts skip the LLM call
+_gemini_cache = TTLCache(maxsize=1024, ttl=3600)
+# Per-prompt lock and the number of tasks holding or waiting on it
+_gemini_locks: Dict[bytes, Tuple[asyncio.Lock, int]] = {}
+
+async def generate_gemini_content(prompt: str):
+    """Return generated text for a prompt, coalescing concurrent identical prompts into one call."""
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    text = _gemini_cache.get(key)
+    if text is not None:
+        return text
+    lock, users = _gemini_locks.get(key, (None, 0))
+    if lock is None:
+        lock = asyncio.Lock()
+    _gemini_locks[key] = (lock, users + 1)
+    try:
+        async with lock:
+            text = _gemini_cache.get(key)
+            if text is None:
+                response = await GEMINI_MODEL.generate_content_async(prompt)
+                text = response.text
+                _gemini_cache[key] = text
+    finally:
+        # Drop the lock only once no task is holding or waiting on it
+        lock, users = _gemini_locks[key]
+        if users == 1:
+            del _gemini_locks[key]
+        else:
+            _gemini_locks[key] = (lock, users - 1)
+    return text
+
+# --- Response Helpers ---
+def cacheable_json_response(request: Request, body: bytes, cache_control: str):
+    """Wrap pre-encoded JSON with Cache-Control and an ETag, answering 304 on a matching If-None-Match."""
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # --- API Endpoints ---
 @app.get("/")
-def read_root():
-    return {"message": "Server is running"}
+async def read_root(request: Request):
+    return cacheable_json_response(request, orjson.dumps({"message": "Server is running"}), "public, max-age=3600")
 
 @app.get("/api/products")
-def get_products(page: int = 1, page_size: int = 50):
+async def get_products(request: Request, page_size: int = Query(50, ge=1, le=100), start_after: Optional[str] = None, start_after_id: Optional[str] = None):
     if not db:
         raise HTTPException(status_code=500, detail="Database not connected")
+    # Document ids can't be empty or contain "/"; the SDK would raise ValueError building the cursor
+    if start_after_id is not None and (not start_after_id or "/" in start_after_id):
+        raise HTTPException(status_code=400, detail="Invalid start_after_id.")
+    key = (page_size, start_after, start_after_id)
+    body = _products_cache.get(key)
+    if body is not None:
+        return cacheable_json_response(request, body, PRODUCTS_CACHE_CONTROL)
+    products_ref = db.collection('products')
+    # Cursor pagination: Firestore bills and scans every doc skipped by offset()
+    # Document id breaks ties so products sharing a name aren't skipped at page boundaries
+    query = products_ref.order_by('name').order_by('__name__').limit(page_size)
+    if start_after is not None and start_after_id is not None:
+        query = query.start_after([start_after, products_ref.document(start_after_id)])
+    elif start_after is not None:
+        # Name-only cursors from older clients still work, without the tiebreak
+        query = query.start_after([start_after])
+    docs = query.stream()
+    # Wait for the first document so query errors still surface as a 500 before streaming starts
     try:
-        products_ref = db.collection('products')
-        query = products_ref.order_by('name').limit(page_size).offset((page - 1) * page_size)
-        docs = query.stream()
-        products = [{"id": doc.id, **doc.to_dict()} for doc in docs]
-        return products
+        first_doc = await anext(docs, None)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch products: {e}")
+    return StreamingResponse(
+        stream_products(key, first_doc, docs),
+        media_type="application/json",
+        # A streamed page can still end in an error, so only complete cached pages are publicly cacheable
+        headers={"Cache-Control": "no-store"},
+    )
 
 @app.post("/api/paypal/create-order")
-def create_paypal_order(cart_items: List[CartItem]):
-    access_token = get_paypal_access_token()
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
-    cart_items_dict = [item.dict() for item in cart_items]
-    total_value = sum(float(item['price']) * int(item['quantity']) for item in cart_items_dict)
-    
-    purchase_units = [{
-        "amount": { "currency_code": "USD", "value": f"{total_value:.2f}" },
-        "payee": { "email_address": PAYPAL_SANDBOX_EMAIL }
-    }]
-    payload = { "intent": "CAPTURE", "purchase_units": purchase_units, "application_context": { "return_url": "https://example.com/return", "cancel_url": "https://example.com/cancel" } }
+async def create_paypal_order(cart_items: List[CartItem]):
+    if not cart_items:
+        raise HTTPException(status_code=400, detail="Cart is empty.")
+    # Token fetch and product lookup are independent, so run them concurrently
+    access_token, products = await asyncio.gather(get_paypal_access_token(), fetch_products_for_cart(cart_items))
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}", "PayPal-Request-Id": str(uuid.uuid4())}
+    missing = [item.id for item in cart_items if item.id not in products]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown products in cart: {', '.join(missing)}")
+    # Price from Firestore, not the client, so totals can't be tampered with
+    total_value = sum((get_product_price(item.id, products[item.id]) * item.quantity for item in cart_items), Decimal(0))
     
+    # Only the amount varies per order; everything else is shared with the template
+    purchase_unit = {**_PURCHASE_UNIT_TEMPLATE, "amount": {"currency_code": "USD", "value": format(total_value, ".2f")}}
+    payload = {**_ORDER_PAYLOAD_TEMPLATE, "purchase_units": [purchase_unit]}
+
     try:
-        response = requests.post(f"{PAYPAL_API_BASE}/v2/checkout/orders", headers=headers, json=payload)
+        response = await send_request("POST", f"{PAYPAL_API_BASE}/v2/checkout/orders", headers=headers, content=orjson.dumps(payload))
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.HTTPError as err:
+    except httpx.HTTPStatusError as err:
         raise HTTPException(status_code=500, detail=f"Failed to create PayPal order: {err.response.text}")
 
 @app.post("/api/paypal/capture-order")
-def capture_order(request: OrderCaptureRequest):
-    return capture_paypal_order(request.order_id)
+async def capture_order(request: OrderCaptureRequest):
+    return await capture_paypal_order(request.order_id)
 
 @app.get("/api/convert-currency")
-def get_exchange_rate(from_currency: str, to_currency: str):
+async def get_exchange_rate(request: Request, from_currency: str, to_currency: str):
     if from_currency == to_currency:
-        return {"rate": 1}
-    try:
-        url = f"https://open.er-api.com/v6/latest/{from_currency}?apikey={OPEN_EXCHANGE_RATES_API_KEY}"
-        response = requests.get(url)
-        response.raise_for_status()
-        rates = response.json().get("rates", {})
-        if to_currency not in rates:
-            raise HTTPException(status_code=404, detail=f"Target currency '{to_currency}' not found.")
-        return {"from": from_currency, "to": to_currency, "rate": rates[to_currency]}
-    except requests.exceptions.HTTPError as err:
-        raise HTTPException(status_code=500, detail=f"Failed to get exchange rate: {err.response.text}")
+        return cacheable_json_response(request, orjson.dumps({"rate": 1}), "public, max-age=600")
+    rates, stale = await get_exchange_rates(from_currency)
+    if to_currency not in rates:
+        raise HTTPException(status_code=404, detail=f"Target currency '{to_currency}' not found.")
+    result = {"from": from_currency, "to": to_currency, "rate": rates[to_currency]}
+    if stale:
+        # Don't let CDNs keep serving a fallback rate once the upstream recovers
+        result["stale"] = True
+        return cacheable_json_response(request, orjson.dumps(result), "no-store")
+    return cacheable_json_response(request, orjson.dumps(result), "public, max-age=600")
 
 @app.post("/api/gemini/generate-email")
-def generate_gemini_email(request: GeminiRequest):
-    if not GEMINI_API_KEY:
+async def generate_gemini_email(request: GeminiRequest):
+    if GEMINI_MODEL is None:
         raise HTTPException(status_code=503, detail="Gemini AI client not configured on backend.")
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(request.prompt)
-        return {"success": True, "emailContent": response.text}
+        email_content = await generate_gemini_content(request.prompt)
+        return {"success": True, "emailContent": email_content}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to generate email content: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to generate email content: {e}")
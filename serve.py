@@ -0,0 +1,14 @@
+import os
+import uvicorn
+
+# Server launcher kept out of main.py so workers importing main:app don't load uvicorn's CLI stack
+if __name__ == "__main__":
+    # I/O-bound app: default to roughly 2x CPU + 1 workers
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1)),
+        loop="uvloop",
+        http="httptools",
+    )